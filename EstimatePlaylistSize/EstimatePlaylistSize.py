@@ -59,13 +59,20 @@
 # If we determine the d-tuple for each of the possible sequences, we will see that any given dd-tuple can be obtained in multiple ways.
 # The number of draw sequences that give rise to a certain dd-tuple is directly proportional to its probability.
 
-import itertools, collections, time
+import itertools, collections, time, os
+import concurrent.futures
 import numpy as np
 import scipy.special
 import math
 import scipy.optimize
 from matplotlib import pyplot as plt
 
+try:
+    # Ahead-of-time compiled kernels, built from _dd_kernels.py by 'make dd_kernels'.
+    from dd_kernels import calc_dd_log_count, calc_dd_log_count_batch, enumerate_dd_into
+except ImportError:
+    from _dd_kernels import calc_dd_log_count, calc_dd_log_count_batch, enumerate_dd_into
+
 # *** num_balls = 5, num_draws = 8
 #
 #     100800 --> (1, 2, 1)
@@ -98,27 +105,177 @@ def brute_force(num_balls, num_draws):
 
     dd_distribution = collections.Counter()
 
-    for draw in itertools.product(*[balls for d in range(num_draws)]):
-        count_duplicates = collections.Counter(collections.Counter(draw).values())
-        dd = tuple(count_duplicates[i] for i in range(1, 1 + max(count_duplicates)))
-        dd_distribution[dd] += 1
+    for draw in itertools.product(balls, repeat = num_draws):
+
+        # Count how often each ball was drawn.
+        counts = [0] * num_balls
+        for ball in draw:
+            counts[ball] += 1
+
+        # Count how many balls were drawn 1, 2, 3, ... times.
+        dd = [0] * num_draws
+        for count in counts:
+            if count != 0:
+                dd[count - 1] += 1
+
+        while dd and dd[-1] == 0:
+            dd.pop()
+
+        dd_distribution[tuple(dd)] += 1
 
     return dd_distribution
 
-def calc_dd_count(dd, num_balls):
+# Table of factorials for small arguments; calc_dd_count() mostly needs factorials of small integers.
+_FACT = tuple(math.factorial(i) for i in range(1024))
+
+def _factorial(n):
+    """ Return n!, from the factorial table if possible.
+    """
+    return _FACT[n] if 0 <= n < len(_FACT) else math.factorial(n)
+
+def calc_dd_count(dd, num_balls, num_unique = None, num_draws = None):
     """ Given a particular dd-tuple and num_balls (the number of different balls in the vase),
           return the number of different draws that result in the dd-tuple given.
+
+        The count is exact, which makes this function suitable for validation; for large num_balls and num_draws,
+          log_dd_count() is much cheaper.
+
+        Callers that already know num_unique and/or num_draws for the dd-tuple may pass them in.
+    """
+
+    if num_unique is None:
+        num_unique = sum(dd)                                  # number of unique balls seen, according to the dd-tuple.
+    if num_draws is None:
+        num_draws = sum(i * d for (i, d) in enumerate(dd, 1)) # number of balls seen (a.k.a., number of draws), according to the dd-tuple.
+
+    denom = 1
+    for (i, d) in enumerate(dd, 1):
+        denom *= _factorial(d) * _factorial(i) ** d
+
+    return _factorial(num_draws) // denom * (_factorial(num_balls) // _factorial(num_balls - num_unique))
+
+def log_dd_count(dd, num_balls):
+    """ Given a particular dd-tuple and num_balls (the number of different balls in the vase),
+          return the natural logarithm of the number of different draws that result in the dd-tuple given.
+
+        This is the floating point counterpart of calc_dd_count(), which avoids huge integers when num_balls
+          and num_draws are large. It accepts any sequence of integers; see also the calc_dd_log_count() kernel,
+          which sums the same terms in a different order, and may therefore differ in the last few digits.
+    """
+    num_unique = sum(dd)
+    num_draws = sum(i * d for (i, d) in enumerate(dd, 1))
+
+    log_count = math.lgamma(num_draws + 1) + math.lgamma(num_balls + 1) - math.lgamma(num_balls - num_unique + 1)
+    for (i, d) in enumerate(dd, 1):
+        log_count -= math.lgamma(d + 1) + d * math.lgamma(i + 1)
+
+    return log_count
+
+def test_log_dd_count():
+    """ Verify that log_dd_count() and the calc_dd_log_count() kernel agree with the logarithm of calc_dd_count(),
+          and that zero-padding a dd-tuple does not change the kernel result.
     """
+    for num_balls in range(1, 16):
+        for num_draws in range(1, 16):
+            for dd in enumerate_dd(num_balls, num_draws):
+                ref = math.log(calc_dd_count(dd, num_balls))
+                dd_array = np.array(dd, dtype = np.int64)
+                dd_padded = np.zeros(num_draws + 5, dtype = np.int64)
+                dd_padded[:len(dd)] = dd
+                assert math.isclose(log_dd_count(dd, num_balls), ref, rel_tol = 1e-12, abs_tol = 1e-12)
+                assert math.isclose(calc_dd_log_count(dd_array, num_balls), ref, rel_tol = 1e-12, abs_tol = 1e-12)
+                assert calc_dd_log_count(dd_padded, num_balls) == calc_dd_log_count(dd_array, num_balls)
+
+    for num_balls in (4980, 10 ** 6):
+        dd = [1639, 859, 69, 20, 1]
+        ref = math.log(calc_dd_count(dd, num_balls))
+        assert math.isclose(log_dd_count(dd, num_balls), ref, rel_tol = 1e-12)
+        assert math.isclose(calc_dd_log_count(np.array(dd, dtype = np.int64), num_balls), ref, rel_tol = 1e-12)
+
+def enumerate_partitions(n, max_parts = None):
+    """ Generate all partitions of n, as lists of parts in non-increasing order.
+
+        If max_parts is given, only partitions with at most max_parts parts are generated.
+    """
+    if n == 0:
+        yield []
+        return
 
-    num_unique = np.sum(dd)                             # number of unique balls seen, according to the dd-tuple.
-    num_draws  = np.dot(dd, np.arange(1, len(dd) + 1))  # number of balls seen (a.k.a., number of draws), according to the dd-tuple.
+    if max_parts is not None and max_parts < 1:
+        return
 
-    return math.factorial(num_draws) // np.product([math.factorial(d) * math.factorial(i) ** d for (i, d) in enumerate(dd, 1)]) * \
-                  (math.factorial(num_balls) // math.factorial(num_balls - num_unique))
+    parts = [n]
+
+    while True:
+
+        yield list(parts)
+
+        remainder = 0
+
+        while True:
+
+            # Remove the trailing ones, and decrement the last part that is greater than one.
+            while parts and parts[-1] == 1:
+                parts.pop()
+                remainder += 1
+
+            if not parts:
+                return
+
+            k = parts.pop() - 1
+            remainder += 1
+
+            # Distributing the remainder over parts that are at most k takes ceil(remainder / k) parts.
+            if max_parts is None or len(parts) + 1 + (remainder + k - 1) // k <= max_parts:
+                break
+
+            # Too many parts; smaller values of this part would need even more. Drop it, and decrement an earlier part.
+            remainder += k
+
+        # Distribute the remainder over parts that are at most k.
+        parts.append(k)
+        while remainder > k:
+            parts.append(k)
+            remainder -= k
+        if remainder > 0:
+            parts.append(remainder)
+
+def partition_enumerate(num_balls, num_draws):
+    """ Determine the dd-distribution by iterating over the partitions of num_draws into at most num_balls parts.
+
+        Each partition is the non-increasing sequence of the number of times each of the observed balls was drawn.
+        Its count is the number of orderings of these draws (a multinomial coefficient), multiplied by the number
+          of ways to assign different balls to the parts, where parts of equal size are interchangeable.
+
+        This yields the same result as brute_force(), but in time proportional to the number of partitions.
+        It does not use calc_dd_count(), so it can be used to validate calc_dd_count() for large cases.
+    """
+    dd_distribution = collections.Counter()
+
+    for parts in enumerate_partitions(num_draws, max_parts = num_balls):
+
+        num_unique = len(parts)
+
+        count = _factorial(num_draws)
+        for k in parts:
+            count //= _factorial(k)
+
+        multiplicities = collections.Counter(parts)
+
+        count *= _factorial(num_balls) // _factorial(num_balls - num_unique)
+        for m in multiplicities.values():
+            count //= _factorial(m)
+
+        dd = tuple(multiplicities[i] for i in range(1, 1 + max(parts, default = 0)))
+        dd_distribution[dd] = count
+
+    return dd_distribution
 
 def test_calc_dd_count():
-    """ Verify that the result of calc_dd_count() is identical to the count we obtain from
-        a brute-force enumeration of all draw sequences.
+    """ Verify that the counts produced by calc_dd_count() for all possible dd-tuples sum up to the
+          total number of draw sequences, and that they agree with the counts obtained by partition_enumerate().
+
+        For small cases, the counts are also cross-checked against a brute-force enumeration of all draw sequences.
     """
     for maxval in range(1, 101):
         for num_balls in range(0, maxval + 1):
@@ -131,117 +288,260 @@ def test_calc_dd_count():
                 print()
 
                 t1 = time.time()
-                bf = brute_force(num_balls, num_draws)
+
+                pe = partition_enumerate(num_balls, num_draws)
+
+                total_count = 0
+                num_distributions = 0
+                for dd in enumerate_dd(num_balls, num_draws):
+                    calc = calc_dd_count(dd, num_balls, num_draws = num_draws)
+                    assert calc == pe[dd]
+                    total_count += calc
+                    num_distributions += 1
+
                 t2 = time.time()
 
                 duration = (t2 - t1)
 
-                total_count = 0
-                for (dd, count) in bf.most_common():
-                    calc = calc_dd_count(dd, num_balls)
-                    print("{:10} --> {}".format(count, dd))
-                    assert (count == calc)
-                    total_count += count
+                assert len(pe) == num_distributions
+
+                if maxval <= 5:
+                    bf = brute_force(num_balls, num_draws)
+                    for (dd, count) in bf.most_common():
+                        calc = calc_dd_count(dd, num_balls, num_draws = num_draws)
+                        print("{:10} --> {}".format(count, dd))
+                        assert (count == calc)
+                    assert len(bf) == num_distributions
 
                 print("---------------")
-                print("{:10} total ; {} distributions ({:.3f} s)".format(total_count, len(bf), duration))
+                print("{:10} total ; {} distributions ({:.3f} s)".format(total_count, num_distributions, duration))
                 print()
 
                 assert total_count == (num_balls ** num_draws)
 
-def enumerate_dd_rec(sofar, balls_unseen, draws_remaining):
-    """ Generate all possible dd-tuples recursively.
+def enumerate_dd(num_balls, num_draws):
+    """ Generate all possible dd-tuples.
+
+        This is a depth-first search over dd-tuple prefixes, using an explicit stack rather than recursion.
+        At a given depth, the current prefix is dd[:depth], and balls_unseen[depth] and draws_remaining[depth]
+        are the number of balls and draws not yet accounted for by that prefix.
+    """
+    dd = [0] * num_draws
+    balls_unseen = [0] * (num_draws + 1)
+    draws_remaining = [0] * (num_draws + 1)
+
+    balls_unseen[0] = num_balls
+    draws_remaining[0] = num_draws
+
+    depth = 0
+
+    while True:
+
+        if draws_remaining[depth] == 0:
+            yield tuple(dd[:depth])
+
+        if draws_remaining[depth] > depth:
+            # Descend: extend the prefix with a zero entry.
+            dd[depth] = 0
+            balls_unseen[depth + 1] = balls_unseen[depth]
+            draws_remaining[depth + 1] = draws_remaining[depth]
+            depth += 1
+            continue
+
+        # Backtrack: increment the deepest prefix entry that can still be incremented.
+        while True:
+            depth -= 1
+            if depth < 0:
+                return
+            dd[depth] += 1
+            b = balls_unseen[depth] - dd[depth]
+            r = draws_remaining[depth] - dd[depth] * (depth + 1)
+            if b >= 0 and r >= 0:
+                balls_unseen[depth + 1] = b
+                draws_remaining[depth + 1] = r
+                depth += 1
+                break
+
+def count_dd(num_balls, num_draws):
+    """ Return the number of different dd-tuples for the given num_balls and num_draws.
+
+        This equals the number of partitions of num_draws into at most num_balls parts, or equivalently,
+          into parts that are at most num_balls in size.
     """
-    if balls_unseen >= 0 and draws_remaining == 0:
-        yield tuple(sofar)
+    ways = [1] + [0] * num_draws
+    for part in range(1, min(num_balls, num_draws) + 1):
+        for s in range(part, num_draws + 1):
+            ways[s] += ways[s - part]
+    return ways[num_draws]
 
-    curr = len(sofar) + 1
+def enumerate_dd_array(num_balls, num_draws, with_log_counts = True):
+    """ Return all possible dd-tuples as a zero-padded 2-D int64 array, together with an array of their log-counts.
 
-    if draws_remaining < curr:
-        return
+        If 'with_log_counts' is False, the log-counts are not computed, and None is returned in their place.
+    """
+    num_rows = count_dd(num_balls, num_draws)
 
-    p = 0
-    while balls_unseen >= 0 and draws_remaining >= 0:
-        yield from enumerate_dd_rec(sofar + [p], balls_unseen, draws_remaining)
-        p += 1
-        balls_unseen -= 1
-        draws_remaining -= curr
+    dd_matrix = np.empty((num_rows, num_draws), dtype = np.int64)
+    log_counts = np.empty(num_rows if with_log_counts else 0, dtype = np.float64)
 
-def enumerate_dd(num_balls, num_draws):
-    """ Generate all possible dd-tuples.
-    """
-    yield from enumerate_dd_rec([], num_balls, num_draws)
+    num_written = enumerate_dd_into(num_balls, num_draws, dd_matrix, log_counts, with_log_counts)
+    if num_written != num_rows:
+        raise RuntimeError("enumerate_dd_into() wrote {} dd-tuples; expected {}".format(num_written, num_rows))
+
+    return (dd_matrix, log_counts if with_log_counts else None)
 
 def fast_enumerate(num_balls, num_draws):
     """ This is functionally equivalent to br
     """
     dd_distribution = collections.Counter()
     for dd in enumerate_dd(num_balls, num_draws):
-        dd_distribution[dd] = calc_dd_count(dd, num_balls)
+        dd_distribution[dd] = calc_dd_count(dd, num_balls, num_draws = num_draws)
     return dd_distribution
 
+def fast_enumerate_soa(num_balls, num_draws):
+    """ Structure-of-arrays version of fast_enumerate().
+
+        Return all possible dd-tuples as the zero-padded rows of a 2-D int64 array, together with
+          a parallel object array holding their exact counts as Python integers.
+
+        The exact counts are computed by calc_dd_count(), one row at a time.
+    """
+    (dd_matrix, _) = enumerate_dd_array(num_balls, num_draws, with_log_counts = False)
+
+    counts = np.empty(len(dd_matrix), dtype = object)
+    for (row, dd) in enumerate(dd_matrix.tolist()):
+        counts[row] = calc_dd_count(dd, num_balls, num_draws = num_draws)
+
+    return (dd_matrix, counts)
+
+def dd_row_to_tuple(dd_row):
+    """ Convert a zero-padded dd-tuple row, as produced by enumerate_dd_array(), to a conventional dd-tuple.
+    """
+    return tuple(int(d) for d in np.trim_zeros(dd_row, "b"))
+
 def test_fast_enumerate():
     for num_balls in range(0, 8):
         for num_draws in range(1, 8):
             bf = brute_force(num_balls, num_draws)
             fe = fast_enumerate(num_balls, num_draws)
+            (dd_matrix, counts) = fast_enumerate_soa(num_balls, num_draws)
             print(num_balls, num_draws)
             assert bf == fe
+            assert fe == dict(zip(map(dd_row_to_tuple, dd_matrix), counts))
+            (dd_matrix, log_counts) = enumerate_dd_array(num_balls, num_draws)
+            for (dd, log_count) in zip(dd_matrix, log_counts):
+                assert math.isclose(log_count, math.log(fe[dd_row_to_tuple(dd)]), rel_tol = 1e-12, abs_tol = 1e-12)
 
 def examine():
+    num_draws = 3
+    ref_dd = np.zeros(num_draws, dtype = np.int64)
+    ref_dd[0] = 3
     for num_balls in range(30):
-        dd_distribution = fast_enumerate(num_balls, 3)
-        cLess = 0
-        cEqual = 0
-        cMore = 0
-        refcount = dd_distribution[(3, )]
-        for dd in dd_distribution:
-            if dd_distribution[dd] < refcount:
-                cLess += calc_dd_count(dd, num_balls)
+        (dd_matrix, counts) = fast_enumerate_soa(num_balls, num_draws)
+        refcount = counts[np.all(dd_matrix == ref_dd, axis = 1)].sum()
+        cLess = counts[counts < refcount].sum()
         print(num_balls, cLess)
 
 def check_tree():
-    dd_distribution = fast_enumerate(6, 9)
-    for dd in dd_distribution:
-        print(dd, dd_distribution[dd])
+    (dd_matrix, counts) = fast_enumerate_soa(6, 9)
+    for (dd, count) in zip(dd_matrix, counts):
+        print(dd_row_to_tuple(dd), count)
+
+def montecarlo_tally(dd, num_balls, num_repeats, rng, batch_size = 1000):
+    """ Sample 'num_repeats' random sequences of draws from a vase containing 'num_balls' balls, using random generator 'rng'.
+        Return the number of sampled sequences that yield a dd-tuple that is less probable than the dd-tuple given
+          (ties count for one half).
 
-def montecarlo(dd, num_balls, num_repeats):
+        Draw sequences are sampled in batches of 'batch_size' sequences, to bound memory usage.
+    """
 
-    num_draws = np.dot(dd, np.arange(1, len(dd) + 1))
+    num_draws = sum(i * d for (i, d) in enumerate(dd, 1))
 
-    dd_count = calc_dd_count(dd, num_balls)
+    # Use the same kernel as for the sampled dd-tuples, so that a sample with exactly the reference dd-tuple
+    # produces exactly the same log-count, and is counted as a tie.
+    dd_log_count = calc_dd_log_count(np.array(dd, dtype = np.int64), num_balls)
 
     smaller = 0.0
 
-    for rep in range(num_repeats):
-        mc_draw = np.random.choice(num_balls, num_draws)
-        mc_count_duplicates = collections.Counter(collections.Counter(mc_draw).values())
-        mc_dd = tuple(mc_count_duplicates[i] for i in range(1, 1 + max(mc_count_duplicates)))
-        #print(mc_dd)
-        mc_count = calc_dd_count(mc_dd, num_balls)
-        if mc_count < dd_count:
-            smaller += 1.0
-        elif mc_count == dd_count:
-            smaller += 0.5
+    for batch_start in range(0, num_repeats, batch_size):
+
+        batch_repeats = min(batch_size, num_repeats - batch_start)
+
+        # Since all balls are equally probable, draw ball indices directly, without a probability vector.
+        mc_draws = rng.integers(0, num_balls, size = (batch_repeats, num_draws), dtype = np.int32)
+        mc_draws.sort(axis = 1)
+
+        # In a sorted draw sequence, each run of identical balls corresponds to a single unique ball.
+        run_start = np.empty((batch_repeats, num_draws), dtype = bool)
+        run_start[:, 0] = True
+        run_start[:, 1:] = mc_draws[:, 1:] != mc_draws[:, :-1]
+
+        # Every row starts a new run, so runs never span rows in the flattened matrix.
+        run_starts = np.flatnonzero(run_start)
+        run_lengths = np.diff(run_starts, append = batch_repeats * num_draws)
+        run_rows = run_starts // num_draws
+
+        # For each sampled sequence, tally how many balls were drawn 1, 2, 3, ... times; this is the dd-tuple.
+        # A single np.bincount() over keys that encode (row, run length) pairs does this for the entire batch.
+        keys = run_rows * (num_draws + 1) + run_lengths
+        mc_dd = np.bincount(keys, minlength = batch_repeats * (num_draws + 1)).reshape(batch_repeats, num_draws + 1)
+
+        mc_log_counts = calc_dd_log_count_batch(mc_dd[:, 1:], num_balls)
+
+        log_count_differences = dd_log_count - mc_log_counts
+
+        smaller += np.where(np.abs(log_count_differences) < 1e-10, 0.5, np.where(log_count_differences > 0, 1.0, 0.0)).sum()
 
-    score = smaller / num_repeats
+    return smaller
+
+def montecarlo(dd, num_balls, num_repeats, rng = None):
+    """ Estimate the probability that a random sequence of draws from a vase containing 'num_balls' balls
+          yields a dd-tuple that is less probable than the dd-tuple given (ties count for one half).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    score = montecarlo_tally(dd, num_balls, num_repeats, rng) / num_repeats
 
     return score
 
+def _mc_worker(dd, num_balls, num_repeats, seed):
+    """ Process pool entry point for montecarlo_tally(). Each worker gets its own, independent, random stream.
+    """
+    rng = np.random.default_rng(seed)
+    return montecarlo_tally(dd, num_balls, num_repeats, rng)
+
 def drive_monte_carlo():
     dd = [1639, 859, 69, 20, 1]
-    xy = []
-    for num_balls in np.arange(4980, 5000, 10):
-        score = montecarlo(dd, num_balls, 10000)
-        print(num_balls, score)
-        xy.append((num_balls, score))
+    num_repeats = 10000
+
+    num_balls_values = np.arange(4980, 5000, 10)
+
+    # Split the repeats for each num_balls value into a fixed number of tasks, each with its own random stream.
+    # The split does not depend on the number of CPU cores, so the scores are reproducible across machines.
+    num_tasks = 16
+    (q, r) = divmod(num_repeats, num_tasks)
+    reps_per_task = [q + (i < r) for i in range(num_tasks) if q + (i < r) > 0]
+
+    child_seeds = iter(np.random.SeedSequence(42).spawn(len(num_balls_values) * len(reps_per_task)))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = os.cpu_count()) as executor:
+        futures = [[executor.submit(_mc_worker, dd, int(num_balls), reps, next(child_seeds)) for reps in reps_per_task]
+                   for num_balls in num_balls_values]
+
+        xy = []
+        for (num_balls, num_balls_futures) in zip(num_balls_values, futures):
+            score = sum(future.result() for future in num_balls_futures) / num_repeats
+            print(num_balls, score)
+            xy.append((num_balls, score))
+
     xy = np.array(xy)
     plt.plot(xy[:,0], xy[:,1], "*")
     plt.show()
 
 def calc_ts_counts(ts, n):
-    for dd in enumerate_dd([], 8, 10):
-        count = calc_dd_count(dd, n)
+    for dd in enumerate_dd(n, ts):
+        count = calc_dd_count(dd, n, num_draws = ts)
         print(count, dd)
 
 def main():
@@ -9,14 +9,30 @@ def HarmonicNumber(s):
     return np.euler_gamma + scipy.special.digamma(s + 1)
 
 def MaximumLikelihoodEstimator(us, ts):
-    return scipy.optimize.brentq(lambda n : n * (HarmonicNumber(n) - HarmonicNumber(n - us)) - ts, us, ts * 100000)
+
+    # We solve f(n) = n * (HarmonicNumber(n) - HarmonicNumber(n - us)) - ts = 0 for n; f is monotonically decreasing in n.
+    # The Euler-Mascheroni constants in HarmonicNumber() cancel out.
+    f = lambda n : n * (scipy.special.digamma(n + 1) - scipy.special.digamma(n - us + 1)) - ts
+
+    # Write f(n) + ts as the sum of n / (n - k) = 1 + k / (n - k) for k in [0 .. us - 1]. For n >= us - 1, k / n <= k / (n - k)
+    # and k / (n - k) <= k / (n - us + 1). The root therefore lies in [n0, n0 + us - 1], where n0 = us * (us - 1) / (2 * (ts - us)).
+    n0 = us * (us - 1) / (2 * max(ts - us, 1))
+
+    (lo, hi) = (max(n0, float(us)), n0 + us)
+
+    # When ts - us is very small and us is large, the true value of f near the root is smaller than the cancellation
+    # noise in the digamma difference, which can hide the sign change on this tight bracket. Fall back to a wide one.
+    if np.sign(f(lo)) * np.sign(f(hi)) > 0:
+        (lo, hi) = (float(us), float(ts * 100000))
+
+    return scipy.optimize.brentq(f, lo, hi)
 
 if __name__ == "__main__":
 
     dd = [int(arg) for arg in sys.argv[1:]]
 
-    us = np.sum(dd)
-    ts = np.dot(dd, np.arange(1, len(dd) + 1))
+    us = sum(dd)
+    ts = sum(i * d for (i, d) in enumerate(dd, 1))
 
     ml = MaximumLikelihoodEstimator(us, ts)
 
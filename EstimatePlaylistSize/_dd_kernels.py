@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+
+# Compiled kernels used by EstimatePlaylistSize.py.
+#
+# Importing this module gives Numba JIT-compiled versions of the kernels. Running it as a script compiles
+# the same kernels ahead-of-time into the 'dd_kernels' extension module (see the Makefile), which
+# EstimatePlaylistSize.py prefers when available; that avoids paying the JIT warm-up in every process,
+# including every process-pool worker.
+#
+# The kernels are deliberately serial: the Monte Carlo driver already runs one worker process per CPU core.
+
+import math
+import numpy as np
+import numba
+
+@numba.njit("float64(int64[:], int64)", cache = True)
+def calc_dd_log_count(dd, num_balls):
+    """ Given a particular dd-tuple (as an int64 array) and num_balls (the number of different balls in the vase),
+          return the natural logarithm of the number of different draws that result in the dd-tuple given.
+
+        Trailing zeroes in the dd array are allowed, so a preallocated array can be re-used for dd-tuples of different lengths.
+    """
+    num_unique = 0
+    num_draws = 0
+    log_denom = 0.0
+
+    for i in range(1, len(dd) + 1):
+        d = dd[i - 1]
+        if d == 0:
+            continue # Zero entries (including the padding) contribute nothing.
+        num_unique += d
+        num_draws += d * i
+        log_denom += math.lgamma(d + 1) + d * math.lgamma(i + 1)
+
+    return math.lgamma(num_draws + 1) - log_denom + math.lgamma(num_balls + 1) - math.lgamma(num_balls - num_unique + 1)
+
+@numba.njit("float64[:](int64[:, :], int64)", cache = True)
+def calc_dd_log_count_batch(dd_matrix, num_balls):
+    """ Apply calc_dd_log_count() to each row of 'dd_matrix', returning an array of log-counts.
+    """
+    num_rows = dd_matrix.shape[0]
+
+    log_counts = np.empty(num_rows, dtype = np.float64)
+
+    for row in range(num_rows):
+        log_counts[row] = calc_dd_log_count(dd_matrix[row], num_balls)
+
+    return log_counts
+
+@numba.njit("int64(int64, int64, int64[:, :], float64[:], boolean)", cache = True)
+def enumerate_dd_into(num_balls, num_draws, dd_matrix, log_counts, compute_log_counts):
+    """ Write all possible dd-tuples as zero-padded rows of 'dd_matrix' and, if 'compute_log_counts' is set, the
+          corresponding calc_dd_log_count() values into 'log_counts'. Return the number of dd-tuples written.
+
+        The search is the same as in EstimatePlaylistSize.enumerate_dd(); 'dd_matrix' must have at least
+          count_dd(num_balls, num_draws) rows and at least num_draws columns. If 'compute_log_counts' is not set,
+          'log_counts' is not used and may be empty.
+    """
+    dd = np.zeros(num_draws, dtype = np.int64)
+    balls_unseen = np.zeros(num_draws + 1, dtype = np.int64)
+    draws_remaining = np.zeros(num_draws + 1, dtype = np.int64)
+
+    balls_unseen[0] = num_balls
+    draws_remaining[0] = num_draws
+
+    num_rows = 0
+    depth = 0
+
+    while depth >= 0:
+
+        if draws_remaining[depth] == 0:
+            dd_matrix[num_rows, :] = 0
+            dd_matrix[num_rows, :depth] = dd[:depth]
+            if compute_log_counts:
+                log_counts[num_rows] = calc_dd_log_count(dd_matrix[num_rows], num_balls)
+            num_rows += 1
+
+        if draws_remaining[depth] > depth:
+            dd[depth] = 0
+            balls_unseen[depth + 1] = balls_unseen[depth]
+            draws_remaining[depth + 1] = draws_remaining[depth]
+            depth += 1
+            continue
+
+        while True:
+            depth -= 1
+            if depth < 0:
+                break
+            dd[depth] += 1
+            b = balls_unseen[depth] - dd[depth]
+            r = draws_remaining[depth] - dd[depth] * (depth + 1)
+            if b >= 0 and r >= 0:
+                balls_unseen[depth + 1] = b
+                draws_remaining[depth + 1] = r
+                depth += 1
+                break
+
+    return num_rows
+
+if __name__ == "__main__":
+
+    from numba.pycc import CC
+
+    cc = CC("dd_kernels")
+
+    for kernel in (calc_dd_log_count, calc_dd_log_count_batch, enumerate_dd_into):
+        cc.export(kernel.__name__, kernel.nopython_signatures[0])(kernel.py_func)
+
+    cc.compile()